@@ -8,6 +8,8 @@ Ganaterm - 超轻量终端AI助手
 
 import json
 import os
+import atexit
+import functools
 import re
 import sys
 import time
@@ -16,29 +18,45 @@ import shlex
 import threading
 import subprocess
 import shutil
+import stat
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
-import tempfile
+from types import MappingProxyType
+from typing import List, Dict, Any, Optional, Tuple, Callable, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
-from prompt_toolkit import PromptSession
-from prompt_toolkit.key_binding import KeyBindings
 from dotenv import load_dotenv
 from colorama import Fore, Style, init
 
 # 导入markdown渲染库
 try:
     import rich
-    from rich.console import Console
-    from rich.markdown import Markdown
+    from rich.console import Console, Group
     from rich.theme import Theme
-    from rich.syntax import Syntax
     from rich.style import Style as RichStyle
+    from rich.live import Live
+    from rich.text import Text
+    from rich.cells import cell_len
     HAS_RICH = True
 except ImportError:
     HAS_RICH = False
 
+# 可选: 使用orjson加速JSON解析
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# 可选: 使用Hyperscan对危险命令做多模式匹配
+try:
+    import hyperscan
+    HAS_HYPERSCAN = True
+except ImportError:
+    HAS_HYPERSCAN = False
+
 # 初始化colorama，支持彩色输出
 init()
 
@@ -46,7 +64,17 @@ init()
 CONFIG_DIR = os.path.expanduser("~/.config/ganaterm")
 ENV_FILE = os.path.join(CONFIG_DIR, ".env")
 HISTORY_FILE = os.path.join(CONFIG_DIR, "history.jsonl")
+HISTORY_MAX_BYTES = 2 * 1024 * 1024  # 历史文件超过该大小时轮转
+HISTORY_TAIL_BYTES = 256 * 1024  # 启动时只读取历史文件末尾的字节数
+HISTORY_CONTEXT_MESSAGES = 50  # 作为上下文加载的历史消息条数
 DEFAULT_SPINNER = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
+SPINNER_PERIOD = 0.08  # 思考动画每帧间隔(秒)
+SPINNER_FAST_PERIOD = 0.016  # 动画刚开始时的帧间隔(秒)
+SPINNER_FAST_DURATION = 0.1  # 使用快速帧间隔的时长(秒)
+STREAM_FLUSH_INTERVAL = 0.033  # 流式输出的最短刷新间隔(秒)，约30Hz
+_SPIN_CLEAR = b"\r\x1b[K"  # 回到行首并清除到行尾
+# 预先生成思考动画的每一帧
+_SPIN_FRAMES = [f"\r{Fore.BLUE}正在思考{Style.RESET_ALL}{c} ".encode() for c in DEFAULT_SPINNER]
 
 # 检测终端类型和功能
 SHELL = os.environ.get("SHELL", "")
@@ -104,9 +132,94 @@ CODE_BOX_STYLE = "cyan"
 CODE_HEADER_STYLE = "cyan"
 INLINE_CODE_STYLE = "cyan" if IS_ZSH and not HAS_TRUECOLOR else "bold cyan on grey11"
 
+# 危险命令关键字列表
+DANGEROUS_PATTERNS = [
+    r"\brm\s+(-[rf]+\s+)?(\/|~|\.\.)",  # 删除重要目录
+    r"\bmv\s+\S+\s+(\/|~)",  # 移动到重要目录
+    r"\bdd\s+",  # dd命令
+    r"\bformat\b",  # 格式化
+    r"\bmkfs\b",  # 创建文件系统
+    r"\b(halt|poweroff|shutdown|reboot)\b",  # 关机命令
+    r":\(\)\s*\{.*\};\s*:",  # Fork炸弹
+    r"\bchmod\s+-[R].*777\b",  # 递归chmod 777
+    r"\b(wget|curl).*\|\s*(bash|sh)\b",  # 下载并执行脚本
+]
+
+# 每个危险模式都必然包含的关键字，命令中一个都没有时无需进行正则匹配
+DANGER_KEYWORDS = (
+    "rm", "mv", "dd", "format", "mkfs", "halt", "poweroff", "shutdown",
+    "reboot", "chmod", "wget", "curl", ":()",
+)
+
+# 预编译正则表达式，避免每次调用时重复查找/编译
+_CODE_BLOCK_RE = re.compile(r"```(\w*)\n([\s\S]*?)\n```")  # ```语言\n代码\n```
+_FENCE_CLOSE_RE = re.compile(r"\n[ \t]*```")  # 代码块结束标记，可带缩进(例如在列表项中)
+_HR_RE = re.compile(r" {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")  # 分隔线
+_LIST_ITEM_RE = re.compile(r"^[ \t]*(?:[-*+]|\d+[.)])[ \t]", re.MULTILINE)  # 无序或有序列表项
+_CMD_LINE_RE = re.compile(r"^(?:\!|\$)\s*(.+)$", re.MULTILINE)  # 以!或$开头的命令行
+_DANGEROUS_RE = re.compile("|".join(f"(?:{p})" for p in DANGEROUS_PATTERNS))  # 合并为单次扫描
+_FILENAME_RES = [
+    re.compile(r"(?:\/\/|#)\s*filename\s*:\s*(\S+)"),  # // filename: name.ext
+    re.compile(r"\/\*\s*filename\s*:\s*(\S+)\s*\*\/"), # /* filename: name.ext */
+    re.compile(r"<!--\s*filename\s*:\s*(\S+)\s*-->"),  # <!-- filename: name.ext -->
+]
+_CLASS_NAME_RE = re.compile(r"class\s+(\w+)")
+
+# 语言到文件扩展名的映射
+FILE_EXTENSIONS = MappingProxyType({
+    "python": ".py",
+    "py": ".py",
+    "javascript": ".js",
+    "js": ".js",
+    "typescript": ".ts",
+    "ts": ".ts",
+    "html": ".html",
+    "css": ".css",
+    "json": ".json",
+    "bash": ".sh",
+    "shell": ".sh",
+    "sh": ".sh",
+    "ruby": ".rb",
+    "go": ".go",
+    "java": ".java",
+    "c": ".c",
+    "cpp": ".cpp",
+    "c++": ".cpp",
+    "rust": ".rs",
+    "rs": ".rs",
+})
+
+# 出现这些字符之一才需要走Markdown渲染，否则按纯文本直接输出
+MARKDOWN_MARKERS = ("`", "#", "*", "_", "[", ">", "|", "~", "-", "=", "<", "&")
+
+# 如果安装了hyperscan，将危险模式编译为一个多模式数据库，一次扫描得出结果
+_DANGEROUS_DB = None
+if HAS_HYPERSCAN:
+    try:
+        _DANGEROUS_DB = hyperscan.Database()
+        _DANGEROUS_DB.compile(
+            expressions=[p.encode() for p in DANGEROUS_PATTERNS],
+            ids=list(range(len(DANGEROUS_PATTERNS))),
+            elements=len(DANGEROUS_PATTERNS),
+            flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(DANGEROUS_PATTERNS)
+        )
+    except Exception:
+        # 编译失败时回退到re
+        _DANGEROUS_DB = None
+
+# JSON解析函数，优先使用orjson
+json_loads = orjson.loads if HAS_ORJSON else json.loads
+
+def json_dumps(obj: Any) -> bytes:
+    """将对象序列化为UTF-8编码的JSON，优先使用orjson"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
 # ====== 配置加载 ======
-# 确保配置目录存在
-os.makedirs(CONFIG_DIR, exist_ok=True)
+# 确保配置目录存在(目录通常已存在，先用一次stat检查)
+if not os.path.isdir(CONFIG_DIR):
+    os.makedirs(CONFIG_DIR, exist_ok=True)
 
 # 加载环境变量
 load_dotenv(ENV_FILE)
@@ -118,6 +231,9 @@ API_KEYS = {
     "xai": os.getenv("XAI_API_KEY", ""),
 }
 
+# 已配置API密钥的模型，按备选顺序排列
+_VALID_MODELS = tuple(m for m in ("deepseek", "xai", "openai") if API_KEYS[m])
+
 # API端点配置
 API_ENDPOINTS = {
     "openai": "https://api.openai.com/v1",
@@ -132,6 +248,9 @@ MODEL_MAP = {
     "xai": "grok-3", 
 }
 
+# 命令行模型参数映射
+_MODEL_FLAGS = {"g": "openai", "d": "deepseek", "x": "xai"}
+
 # 系统提示词（如果需要个性化一些就在这加上您想要的回复风格）
 SYSTEM_PROMPT = (
     "你是一个轻量级终端AI助手，具有以下能力:\n"
@@ -149,10 +268,8 @@ SYSTEM_PROMPT = (
     "始终在代码块中明确注明语言类型，以便正确识别。"
 )
 
-# 打字效果配置
-USE_TYPEWRITER = True  # 是否启用打字效果
-TYPING_SPEED_WPM = 256  # 每分钟字数 (越高越快)
-HAS_PV = shutil.which("pv") is not None  # 检查是否安装了pv
+# 终端宽度，启动时获取一次，窗口大小变化时由SIGWINCH刷新
+_TERM_WIDTH = shutil.get_terminal_size().columns
 
 # Markdown渲染配置
 USE_MARKDOWN = HAS_RICH and os.getenv("USE_MARKDOWN", "true").lower() == "true"
@@ -170,7 +287,7 @@ if HAS_RICH:
             theme=CUSTOM_THEME,
             highlight=True,
             color_system=color_system,
-            width=shutil.get_terminal_size().columns
+            width=_TERM_WIDTH
         )
     except Exception:
         # 降级到基本配置
@@ -182,6 +299,8 @@ else:
 # 初始化聊天历史
 history = [{"role": "system", "content": SYSTEM_PROMPT}]
 current_model = "openai"  
+_HISTORY_FP = None  # 历史文件句柄，在整个进程中保持打开
+_PENDING_HIST = []  # 尚未写入历史文件的记录 (时间, 角色, 内容)
 
 # 获取代理设置
 http_proxy = os.getenv("HTTP_PROXY")
@@ -192,17 +311,57 @@ if http_proxy:
 if https_proxy:
     proxies["https"] = https_proxy
 
+def create_session(provider: str) -> requests.Session:
+    """为API服务创建带连接池和重试的会话
+    
+    Args:
+        provider: 服务名称 (openai/deepseek/xai)
+        
+    Returns:
+        预先配置好请求头和代理的会话对象
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),  # 默认不重试POST
+        raise_on_status=False  # 重试用尽后交给raise_for_status处理
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Authorization": f"Bearer {API_KEYS[provider]}",
+        "Content-Type": "application/json"
+    })
+    session.proxies.update(proxies)
+    return session
+
+# 每个API服务一个常驻会话，进程内复用TCP/TLS连接
+SESSIONS = {provider: create_session(provider) for provider in API_ENDPOINTS}
+
 # ====== 辅助函数 ======
 def signal_handler(sig, frame):
     """处理Ctrl+C中断信号"""
     print(f"\n{Fore.YELLOW}Ctrl+C 被按下，正在退出...{Style.RESET_ALL}")
     sys.exit(0)
 
+def refresh_term_width(sig, frame):
+    """终端窗口大小变化时刷新缓存的终端宽度"""
+    global _TERM_WIDTH
+    _TERM_WIDTH = shutil.get_terminal_size().columns
+    if console is not None:
+        console.width = _TERM_WIDTH
+
 # 注册信号处理
 signal.signal(signal.SIGINT, signal_handler)
+if hasattr(signal, "SIGWINCH"):
+    signal.signal(signal.SIGWINCH, refresh_term_width)
 
+@functools.lru_cache(maxsize=256)
 def colored_text(text: str, color: str) -> str:
-    """返回彩色文本
+    """返回彩色文本(结果会被缓存，重复的状态提示无需重新拼接)
     
     Args:
         text: 要着色的文本
@@ -213,180 +372,297 @@ def colored_text(text: str, color: str) -> str:
     """
     return f"{color}{text}{Style.RESET_ALL}"
 
-def spinner_animation(stop_event: threading.Event):
-    """显示思考中的动画
+class SpinnerService:
+    """常驻的思考动画服务
     
-    Args:
-        stop_event: 线程停止事件
+    整个程序只启动一个后台线程，通过start()/stop()控制动画的显示和清除，
+    不必每次请求都创建和等待新线程
     """
-    spinner = DEFAULT_SPINNER
-    i = 0
-    thinking_text = colored_text("正在思考", Fore.BLUE)
     
-    while not stop_event.is_set():
-        sys.stdout.write(f"\r{thinking_text}{spinner[i]} ")
-        sys.stdout.flush()
-        i = (i + 1) % len(spinner)
-        time.sleep(0.1)
+    def __init__(self):
+        self._active = threading.Event()  # 动画是否正在显示
+        self._wake = threading.Event()  # 用于在停止时立即打断帧间等待
+        self._lock = threading.Lock()  # 保证stop()清除后不会再写出动画帧
+        # 动画绕过colorama直接写文件描述符，输出不是终端时(例如重定向到文件)不显示
+        self._enabled = os.isatty(1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
     
-    # 完全清除思考动画行
-    sys.stdout.write("\r" + " " * (len("正在思考") + 10) + "\r")
-    sys.stdout.flush()
+    def start(self):
+        """开始显示思考动画"""
+        if not self._enabled:
+            return
+        with self._lock:
+            if self._active.is_set():
+                return
+            # 动画直接写入文件描述符，先把缓冲区中已有的输出刷出去
+            sys.stdout.flush()
+            self._wake.clear()
+            self._active.set()
+    
+    def stop(self):
+        """停止思考动画并清除动画行，重复调用没有影响"""
+        with self._lock:
+            if not self._active.is_set():
+                return
+            self._active.clear()
+            self._wake.set()
+            os.write(1, _SPIN_CLEAR)
+    
+    def _run(self):
+        """后台线程: 等待start()，然后逐帧绘制直到stop()"""
+        while True:
+            self._active.wait()
+            i = 0
+            started = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._active.is_set():
+                        break
+                    os.write(1, _SPIN_FRAMES[i])
+                i = (i + 1) % len(_SPIN_FRAMES)
+                # 刚开始时快速刷新，请求很快返回时动画也能及时响应
+                if time.monotonic() - started < SPINNER_FAST_DURATION:
+                    period = SPINNER_FAST_PERIOD
+                else:
+                    period = SPINNER_PERIOD
+                self._wake.wait(period)  # stop()时立即返回
+
+# 全局思考动画服务
+spinner = SpinnerService()
 
 def load_history() -> List[Dict[str, str]]:
-    """从文件加载聊天历史
+    """从文件加载最近的聊天历史
+    
+    只解析历史文件末尾的部分记录；文件过大时会轮转为history.jsonl.1
     
     Returns:
         聊天历史记录列表
     """
-    if not os.path.exists(HISTORY_FILE):
-        return [{"role": "system", "content": SYSTEM_PROMPT}]
-    
     result = [{"role": "system", "content": SYSTEM_PROMPT}]
-    with open(HISTORY_FILE, 'r', encoding="utf-8") as f:
+    try:
+        size = os.path.getsize(HISTORY_FILE)
+    except OSError:
+        return result
+    
+    messages = []
+    with open(HISTORY_FILE, 'rb') as f:
+        if size > HISTORY_TAIL_BYTES:
+            # 从末尾附近开始读取，丢弃不完整的第一行
+            f.seek(size - HISTORY_TAIL_BYTES - 1)
+            f.readline()
         for line in f:
+            if not line.strip():
+                continue
             try:
-                msg = json.loads(line.strip())
-                result.append({"role": msg["role"], "content": msg["content"]})
+                msg = json_loads(line)
+                messages.append({"role": msg["role"], "content": msg["content"]})
             except json.JSONDecodeError:
                 print(colored_text("历史文件解析错误，跳过这行", Fore.YELLOW))
+    result.extend(messages[-HISTORY_CONTEXT_MESSAGES:])
+    
+    # 历史文件过大时轮转，之后的记录写入新文件
+    if size > HISTORY_MAX_BYTES:
+        os.replace(HISTORY_FILE, HISTORY_FILE + ".1")
     return result
 
+def open_history_file():
+    """以追加模式打开历史文件(带缓冲)
+    
+    Returns:
+        历史文件句柄
+    """
+    global _HISTORY_FP
+    if _HISTORY_FP is None:
+        _HISTORY_FP = open(HISTORY_FILE, "ab", buffering=64 * 1024)
+    return _HISTORY_FP
+
 def save_to_history(role: str, content: str):
-    """保存消息到历史记录
+    """保存消息到历史记录(先暂存，由flush_history统一写入)
     
     Args:
         role: 角色 (user/assistant)
         content: 消息内容
     """
-    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-        line = json.dumps(
-            {"time": str(datetime.now()), "role": role, "content": content},
-            ensure_ascii=False
-        )
-        f.write(line + "\n")
+    _PENDING_HIST.append((str(datetime.now()), role, content))
+
+def flush_history():
+    """将暂存的历史记录拼成一次写入并刷新到文件"""
+    if not _PENDING_HIST:
+        return
+    fp = open_history_file()
+    fp.write(b"".join(
+        json_dumps({"time": t, "role": role, "content": content}) + b"\n"
+        for t, role, content in _PENDING_HIST
+    ))
+    fp.flush()
+    _PENDING_HIST.clear()
+
+def close_history():
+    """写入暂存的历史记录并关闭历史文件"""
+    flush_history()
+    if _HISTORY_FP is not None:
+        _HISTORY_FP.close()
 
-def print_with_typewriter(text: str):
-    """使用打字机效果打印文本
+# 程序退出时(包括Ctrl+C)保存尚未写入的历史记录
+atexit.register(close_history)
+
+def print_response(text: str):
+    """打印完整的回复文本(流式回复已在stream_response中逐字输出)
     
     Args:
         text: 要打印的文本
     """
-    if not USE_TYPEWRITER:
-        if USE_MARKDOWN:
-            render_markdown(text)
-        else:
-            print(text)
-        return
-        
-    # 为内联代码添加高亮，确保在打字效果前处理
     if USE_MARKDOWN:
-        text_with_highlights = highlight_inline_code(text)
+        render_markdown(text)
     else:
-        text_with_highlights = text
+        sys.stdout.write(text + "\n")
+        sys.stdout.flush()
+
+def _parse_md(text: str) -> List[Tuple[str, ...]]:
+    """单遍扫描Markdown文本，切分出普通文本和代码块
+    
+    内联代码留在普通文本中，由Rich的Markdown渲染(markdown.code样式)
+    
+    Args:
+        text: Markdown格式的文本
         
-    if HAS_PV:
-        # 使用pv实现打字效果
-        try:
-            rate = int(len(text_with_highlights) / ((TYPING_SPEED_WPM / 60) / 5)) # 估算合适的速率
-            
-            if USE_MARKDOWN:
-                # 临时文件方法，确保完整的渲染
-                with tempfile.NamedTemporaryFile(mode='w+', delete=False) as tmp:
-                    tmp_path = tmp.name
-                    process = subprocess.Popen(
-                        ["pv", "-qL", str(rate)], 
-                        stdin=subprocess.PIPE, 
-                        stdout=tmp,
-                        text=True
-                    )
-                    process.communicate(input=text_with_highlights)
-                    
-                # 读取临时文件并用Rich渲染
-                with open(tmp_path, 'r') as f:
-                    content = f.read()
-                os.unlink(tmp_path)  # 删除临时文件
-                render_markdown(content)
-            else:
-                process = subprocess.Popen(
-                    ["pv", "-qL", str(rate)], 
-                    stdin=subprocess.PIPE, 
-                    stdout=sys.stdout,
-                    text=True
-                )
-                process.communicate(input=text_with_highlights)
-        except Exception as e:
-            print(f"pv出错: {e}")
-            if USE_MARKDOWN:
-                render_markdown(text_with_highlights)
-            else:
-                print(text_with_highlights)  # 出错时直接打印
-    else:
-        # 手动实现打字效果
-        if USE_MARKDOWN:
-            # 如果使用Markdown，先收集完整文本再渲染
-            full_text = ""
-            delay = 60 / (TYPING_SPEED_WPM * 5)  # 估算每个字符的延迟时间
-            for char in text_with_highlights:
-                full_text += char
-                # 使用简单的预览
-                print(char, end='', flush=True)
-                time.sleep(delay)
-            print()  # 换行
-            # 清除之前的输出并重新渲染
-            sys.stdout.write("\033[F")  # 回到上一行
-            sys.stdout.write("\033[K")  # 清除行
-            render_markdown(full_text)
-        else:
-            delay = 60 / (TYPING_SPEED_WPM * 5)  # 估算每个字符的延迟时间
-            for char in text_with_highlights:
-                print(char, end='', flush=True)
-                time.sleep(delay)
-            print()  # 最后换行
+    Returns:
+        片段列表，每项为("text", 文本)或("block", 语言, 代码)
+    """
+    spans = []
+    n = len(text)
+    start = 0  # 尚未输出的普通文本起点
+    i = text.find("```")
+    
+    while i != -1:
+        # 代码块: ```语言\n代码\n```
+        j = i + 3
+        while j < n and (text[j].isalnum() or text[j] == "_"):
+            j += 1
+        if j < n and text[j] == "\n":
+            close = _FENCE_CLOSE_RE.search(text, j)
+            end = close.start() if close else -1
+            if start < i:
+                spans.append(("text", text[start:i]))
+            lang = text[i + 3:j] or "text"
+            if end == -1:
+                # 代码块未闭合(例如回复被截断)，剩余内容都作为代码
+                spans.append(("block", lang, text[j + 1:]))
+                return spans
+            spans.append(("block", lang, text[j + 1:end]))
+            start = close.end()
+            i = text.find("```", start)
+            continue
+        i = text.find("```", i + 1)
+    
+    if start < n:
+        spans.append(("text", text[start:]))
+    return spans
 
-def highlight_inline_code(text: str) -> str:
-    """为内联代码添加语法高亮
+@functools.lru_cache(maxsize=128)
+def _build_syntax(code: str, lang: str, theme: str) -> "Syntax":
+    """构建代码高亮对象，按内容缓存以免重复渲染同一代码块
     
     Args:
-        text: 包含内联代码的文本
+        code: 代码内容
+        lang: 代码语言
+        theme: 语法高亮主题
         
     Returns:
-        处理后的文本，内联代码被Rich样式标签包围
+        Rich的Syntax对象
     """
-    # 修改正则匹配模式，支持多种内联代码情况
-    # 匹配 `code` 但避免匹配已包含标签的代码和代码块
-    processed_text = text
-    
-    # 先检查文本是否已包含Rich样式标签
-    if "[bold cyan on grey11]" not in text:
-        # 匹配单个反引号包围的代码(不在代码块```中)
-        inline_pattern = r'(?<!\`)\`([^\`\n]+?)\`(?!\`)'
+    # 延迟导入，rich.syntax会引入pygments
+    from rich.syntax import Syntax
+    return Syntax(
+        code, 
+        lang, 
+        theme=theme,
+        line_numbers=len(code.splitlines()) > 5 and not IS_ZSH,  # 5行以上显示行号，但在zsh中禁用
+        word_wrap=True,
+        indent_guides=True and not IS_ZSH,  # zsh中禁用缩进指南
+        background_color="default"
+    )
+
+@functools.lru_cache(maxsize=128)
+def _build_markdown(text: str) -> "Markdown":
+    """构建Markdown对象，按内容缓存以免重复解析同一段文本
+    
+    Args:
+        text: Markdown格式的文本
         
-        # 对文本中的内联代码进行替换，但跳过代码块中的内容
-        in_code_block = False
-        result = []
+    Returns:
+        Rich的Markdown对象
+    """
+    # 延迟导入，纯文本回复不需要加载Markdown解析器
+    from rich.markdown import Markdown
+    return Markdown(text)
+
+@functools.lru_cache(maxsize=16)
+def _borders(lang_label: str, width: int) -> Tuple[str, str]:
+    """生成代码块的顶部和底部边框，按语言标签和终端宽度缓存
+    
+    Args:
+        lang_label: 显示在顶部边框上的语言标签
+        width: 终端宽度
         
-        for line in text.split('\n'):
-            # 检测代码块开始或结束
-            if line.strip().startswith('```'):
-                in_code_block = not in_code_block
-                result.append(line)
-                continue
-                
-            # 只对非代码块内的文本进行替换
-            if not in_code_block:
-                # 替换单行中的所有内联代码
-                line = re.sub(
-                    inline_pattern,
-                    lambda m: f"[{INLINE_CODE_STYLE}]`{m.group(1)}`[/{INLINE_CODE_STYLE}]",
-                    line
-                )
-            
-            result.append(line)
-            
-        processed_text = '\n'.join(result)
+    Returns:
+        (顶部边框, 底部边框)
+    """
+    # 计算填充长度
+    fill_length = max(width - len(lang_label) - 4, 0)
+    top_border = f"{CODE_BOX_TOP_LEFT}{CODE_BOX_HORIZONTAL*2}{lang_label}{CODE_BOX_HORIZONTAL * fill_length}{CODE_BOX_TOP_RIGHT}"
+    bottom_border = f"{CODE_BOX_BOTTOM_LEFT}{CODE_BOX_HORIZONTAL * (width - 2)}{CODE_BOX_BOTTOM_RIGHT}"
+    return top_border, bottom_border
+
+def _print_code_block(lang: str, code: str):
+    """带边框和语法高亮地输出一个代码块
+    
+    Args:
+        lang: 代码语言
+        code: 代码内容
+    """
+    # 使用缓存的终端宽度和边框，创建顶部边框和标题 - 使用兼容字符
+    top_border, bottom_border = _borders(f" {lang} ", _TERM_WIDTH)
+    
+    # 根据终端环境选择合适的语法高亮主题
+    syntax_theme = "monokai"
+    if IS_ZSH and not HAS_TRUECOLOR:
+        syntax_theme = "vim"  # vim主题在非真彩色终端上效果更好
+    
+    def plain_body():
+        # 简化模式，只使用基本格式
+        return Text("\n".join(f"{CODE_BOX_VERTICAL} {line.rstrip()}" for line in code.split('\n')))
+    
+    # 边框和代码内容合并为一次输出
+    def print_box(body):
+        console.print(Group(Text(top_border, style=CODE_BOX_STYLE), body, Text(bottom_border, style=CODE_BOX_STYLE)))
+    
+    # 在zsh中可能需要简化显示
+    if IS_ZSH and not IS_TERM_SUPPORTED:
+        print_box(plain_body())
+    else:
+        # 尝试找到最合适的语言类型处理
+        try:
+            # 使用Rich的Syntax对象实现更好的代码高亮
+            print_box(_build_syntax(code, lang, syntax_theme))
+        except Exception as e:
+            # 如果特定语言无法高亮，回退到默认文本显示
+            print_box(plain_body())
+
+def _print_markdown_text(text: str):
+    """用Rich的Markdown渲染器输出代码块之外的文本
     
-    return processed_text
+    Args:
+        text: Markdown格式的文本
+    """
+    if not text.strip():
+        return
+    try:
+        console.print(_build_markdown(text))
+    except Exception as e:
+        # 如果Rich的Markdown渲染器出错，尝试直接输出文本
+        console.print(text)
 
 def render_markdown(text: str):
     """渲染Markdown文本
@@ -395,135 +671,47 @@ def render_markdown(text: str):
         text: Markdown格式的文本
     """
     if HAS_RICH and USE_MARKDOWN:
+        # 纯文本直接输出，跳过Markdown解析和代码块检测(有序列表没有标记字符，单独检查)
+        if not any(marker in text for marker in MARKDOWN_MARKERS) and not _LIST_ITEM_RE.search(text):
+            # 与Markdown渲染一致，不输出末尾的空行
+            console.print(text.rstrip("\n"), markup=False, highlight=False)
+            return
+        
         try:
             # 预处理代码块，确保代码块正确显示
             # 将模型可能输出的```命令，改为```bash以确保正确高亮
-            text = re.sub(r'```命令\n', '```bash\n', text)
-            
-            # 预处理内联代码，为inline code添加背景颜色和高亮
-            text_with_inline_highlights = highlight_inline_code(text)
-            
-            # 检测和处理代码块，为其应用高亮
-            code_blocks = detect_code_blocks(text)
+            text = text.replace("```命令\n", "```bash\n")
             
-            # 如果找到代码块，直接使用Rich的语法高亮功能
-            if code_blocks:
-                # 先输出普通文本
-                content_parts = []
-                last_end = 0
-                
-                for block in sorted(code_blocks, key=lambda x: x["start"]):
-                    # 添加代码块前的文本
-                    if block["start"] > last_end:
-                        pre_text = text_with_inline_highlights[last_end:block["start"]]
-                        if pre_text.strip():
-                            content_parts.append(pre_text)
-                    
-                    # 获取代码块信息
-                    lang = block["language"]
-                    code = block["content"]
-                    
-                    # 获取终端宽度，创建美观的边框
-                    term_width = shutil.get_terminal_size().columns
-                    
-                    # 创建顶部边框和标题 - 使用兼容字符
-                    lang_label = f" {lang} "
-                    # 计算填充长度
-                    fill_length = term_width - len(lang_label) - 4
-                    if fill_length < 0:
-                        fill_length = 0
-                    
-                    top_border = f"{CODE_BOX_TOP_LEFT}{CODE_BOX_HORIZONTAL*2}{lang_label}{CODE_BOX_HORIZONTAL * fill_length}{CODE_BOX_TOP_RIGHT}"
-                    bottom_border = f"{CODE_BOX_BOTTOM_LEFT}{CODE_BOX_HORIZONTAL * (term_width - 2)}{CODE_BOX_BOTTOM_RIGHT}"
-                    
-                    console.print(top_border, style=CODE_BOX_STYLE)
-                    
-                    # 根据终端环境选择合适的语法高亮主题
-                    syntax_theme = "monokai"
-                    if IS_ZSH and not HAS_TRUECOLOR:
-                        syntax_theme = "vim"  # vim主题在非真彩色终端上效果更好
-                    
-                    # 在zsh中可能需要简化显示
-                    if IS_ZSH and not IS_TERM_SUPPORTED:
-                        # 简化模式，只使用基本格式
-                        for line in code.split('\n'):
-                            console.print(f"{CODE_BOX_VERTICAL} {line.rstrip()}")
-                    else:
-                        # 尝试找到最合适的语言类型处理
-                        try:
-                            # 使用Rich的Syntax对象实现更好的代码高亮
-                            syntax = Syntax(
-                                code, 
-                                lang, 
-                                theme=syntax_theme,
-                                line_numbers=len(code.splitlines()) > 5 and not IS_ZSH,  # 5行以上显示行号，但在zsh中禁用
-                                word_wrap=True,
-                                indent_guides=True and not IS_ZSH,  # zsh中禁用缩进指南
-                                background_color="default"
-                            )
-                            console.print(syntax)
-                        except Exception as e:
-                            # 如果特定语言无法高亮，回退到默认文本显示
-                            for line in code.split('\n'):
-                                console.print(f"{CODE_BOX_VERTICAL} {line.rstrip()}")
-                    
-                    # 底部边框
-                    console.print(bottom_border, style=CODE_BOX_STYLE)
-                    
-                    last_end = block["end"]
-                
-                # 添加最后一个代码块后的文本
-                if last_end < len(text):
-                    post_text = text_with_inline_highlights[last_end:]
-                    if post_text.strip():
-                        content_parts.append(post_text)
-                
-                # 渲染代码块之外的Markdown文本
-                for part in content_parts:
-                    if part.strip():
-                        try:
-                            # 使用Rich的Markdown渲染器处理普通文本
-                            md = Markdown(part)
-                            console.print(md)
-                        except Exception as e:
-                            # 如果Rich的Markdown渲染器出错，尝试直接输出文本
-                            console.print(part)
-            else:
-                # 确保代码块闭合
-                if text.count('```') % 2 != 0:
-                    text_with_inline_highlights += '\n```'
-                
-                # 如果没有代码块，直接渲染整个文本
-                try:
-                    console.print(Markdown(text_with_inline_highlights))
-                except Exception as e:
-                    # 如果Rich的Markdown渲染器出错，尝试分行输出
-                    print(f"Markdown渲染出错，使用纯文本显示: {e}")
-                    for line in text_with_inline_highlights.split('\n'):
-                        console.print(line)
+            # 单遍切分文本，按原顺序依次输出普通文本和代码块
+            for span in _parse_md(text):
+                if span[0] == "text":
+                    _print_markdown_text(span[1])
+                else:
+                    _print_code_block(span[1], span[2])
         except Exception as e:
             print(f"Markdown渲染出错: {e}")
             print(text)  # 出错时直接打印
     else:
         print(text)
 
-def execute_command(command: str) -> Tuple[str, bool]:
-    """执行Shell命令并返回结果
+def execute_command(command: Union[str, List[str]]) -> Tuple[str, bool]:
+    """执行命令并返回结果
     
     Args:
-        command: 要执行的Shell命令
+        command: 要执行的Shell命令字符串，或直接执行(不经过shell)的参数列表
         
     Returns:
         命令输出结果和执行是否成功的标志
     """
     try:
-        # 直接在当前shell中执行命令，不改变目录
-        print(colored_text(f"执行命令: {command}", Fore.BLUE))
+        # 直接在当前目录执行命令，不改变目录
+        display = command if isinstance(command, str) else shlex.join(command)
+        print(colored_text(f"执行命令: {display}", Fore.BLUE))
         
         # 执行命令并实时显示输出
         process = subprocess.Popen(
             command,
-            shell=True,
+            shell=isinstance(command, str),  # 参数列表不需要额外启动shell
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -575,25 +763,31 @@ def is_dangerous_command(command: str) -> bool:
     Returns:
         如果命令危险则返回True
     """
-    # 危险命令关键字列表
-    dangerous_patterns = [
-        r"\brm\s+(-[rf]+\s+)?(\/|~|\.\.)",  # 删除重要目录
-        r"\bmv\s+\S+\s+(\/|~)",  # 移动到重要目录
-        r"\bdd\s+",  # dd命令
-        r"\bformat\b",  # 格式化
-        r"\bmkfs\b",  # 创建文件系统
-        r"\b(halt|poweroff|shutdown|reboot)\b",  # 关机命令
-        r":(){.*};:",  # Fork炸弹
-        r"\bchmod\s+-[R].*777\b",  # 递归chmod 777
-        r"\b(wget|curl).*\|\s*(bash|sh)\b",  # 下载并执行脚本
-    ]
+    # 绝大多数命令不含任何危险关键字，直接放行
+    if not any(keyword in command for keyword in DANGER_KEYWORDS):
+        return False
     
-    # 检查命令是否匹配危险模式
-    for pattern in dangerous_patterns:
-        if re.search(pattern, command):
-            return True
-            
-    return False
+    if _DANGEROUS_DB is not None:
+        matches = []
+        try:
+            _DANGEROUS_DB.scan(
+                command.encode("utf-8"),
+                match_event_handler=_on_dangerous_match,
+                context=matches
+            )
+        except hyperscan.error:
+            # 命中后回调会终止扫描；没有命中说明是扫描本身出错
+            if not matches:
+                return _DANGEROUS_RE.search(command) is not None
+        return bool(matches)
+    
+    # 所有危险模式合并为一个正则，只扫描一遍命令
+    return _DANGEROUS_RE.search(command) is not None
+
+def _on_dangerous_match(match_id: int, start: int, end: int, flags: int, context: List[int]) -> bool:
+    """Hyperscan匹配回调，记录命中的模式并终止扫描"""
+    context.append(match_id)
+    return True
 
 def detect_code_blocks(text: str) -> List[Dict[str, str]]:
     """从文本中检测代码块
@@ -606,9 +800,8 @@ def detect_code_blocks(text: str) -> List[Dict[str, str]]:
     """
     # 匹配Markdown代码块 ```语言\n代码\n```
     code_blocks = []
-    pattern = r"```(\w*)\n([\s\S]*?)\n```"
     
-    for match in re.finditer(pattern, text):
+    for match in _CODE_BLOCK_RE.finditer(text):
         lang = match.group(1) or "text"
         code = match.group(2)
         
@@ -638,47 +831,27 @@ def suggest_filename(code_block: Dict[str, str]) -> str:
     Returns:
         推荐的文件名
     """
-    lang = code_block["language"].lower()
-    content = code_block["content"]
-    
-    # 语言到文件扩展名的映射
-    extensions = {
-        "python": ".py",
-        "py": ".py",
-        "javascript": ".js",
-        "js": ".js",
-        "typescript": ".ts",
-        "ts": ".ts",
-        "html": ".html",
-        "css": ".css",
-        "json": ".json",
-        "bash": ".sh",
-        "shell": ".sh",
-        "sh": ".sh",
-        "ruby": ".rb",
-        "go": ".go",
-        "java": ".java",
-        "c": ".c",
-        "cpp": ".cpp",
-        "c++": ".cpp",
-        "rust": ".rs",
-        "rs": ".rs",
-    }
+    return _suggest_filename_impl(code_block["language"].lower(), code_block["content"])
+
+@functools.lru_cache(maxsize=64)
+def _suggest_filename_impl(lang: str, content: str) -> str:
+    """suggest_filename的实现，按(语言, 内容)缓存结果
     
+    Args:
+        lang: 小写的语言类型
+        content: 代码内容
+        
+    Returns:
+        推荐的文件名
+    """
     # 尝试从内容中检测文件名
-    filename_patterns = [
-        r"(?:\/\/|#)\s*filename\s*:\s*(\S+)",  # // filename: name.ext
-        r"\/\*\s*filename\s*:\s*(\S+)\s*\*\/", # /* filename: name.ext */
-        r"<!--\s*filename\s*:\s*(\S+)\s*-->",  # <!-- filename: name.ext -->
-    ]
-    
-    for pattern in filename_patterns:
-        match = re.search(pattern, content)
+    for pattern in _FILENAME_RES:
+        match = pattern.search(content)
         if match:
             return match.group(1)
     
     # 根据语言类型生成默认文件名
-    ext = extensions.get(lang, ".txt")
+    ext = FILE_EXTENSIONS.get(lang, ".txt")
     
     # 为主要语言类型生成更具体的文件名
     if lang in ["python", "py"]:
@@ -686,7 +859,7 @@ def suggest_filename(code_block: Dict[str, str]) -> str:
             return "main.py"
         elif "class" in content:
             # 尝试提取类名
-            class_match = re.search(r"class\s+(\w+)", content)
+            class_match = _CLASS_NAME_RE.search(content)
             if class_match:
                 return f"{class_match.group(1).lower()}.py"
     elif lang in ["js", "javascript"]:
@@ -718,188 +891,356 @@ def write_to_file(filename: str, content: str) -> bool:
         print(colored_text(f"写入文件失败: {e}", Fore.RED))
         return False
 
-def call_openai_api(messages: List[Dict[str, str]]) -> str:
+def call_openai_api(messages: List[Dict[str, str]]) -> requests.Response:
     """使用新版OpenAI API调用
     
     Args:
         messages: 消息历史记录
         
     Returns:
-        完整的响应文本
-    """
-    if not API_KEYS["openai"]:
-        return colored_text(f"错误: 未配置OpenAI API密钥", Fore.RED)
+        流式响应对象
         
+    Raises:
+        requests.RequestException: 请求失败或返回错误状态码
+    """
     # 使用requests库模拟新版API调用
-    headers = {
-        "Authorization": f"Bearer {API_KEYS['openai']}", 
-        "Content-Type": "application/json"
-    }
-    
     data = {
         "model": MODEL_MAP["openai"],
         "messages": messages,
         "stream": True
     }
     
-    try:
-        # 使用会话对象以便复用连接
-        session = requests.Session()
-        response = session.post(
-            f"{API_ENDPOINTS['openai']}/chat/completions",
-            headers=headers,
-            json=data,
-            proxies=proxies,
-            timeout=60,
-            stream=True
-        )
-        response.raise_for_status()
-        
-        # 返回响应流
-        return response
-    except Exception as e:
-        print(colored_text(f"OpenAI API调用出错: {str(e)}", Fore.RED))
-        return None
+    # 使用常驻会话对象以便复用连接；出错时抛出异常，由调用方在停止思考动画后报告
+    response = SESSIONS["openai"].post(
+        f"{API_ENDPOINTS['openai']}/chat/completions",
+        json=data,
+        timeout=60,
+        stream=True
+    )
+    response.raise_for_status()
+    
+    # 返回响应流
+    return response
 
-def call_xai_api(messages: List[Dict[str, str]]) -> str:
+def call_xai_api(messages: List[Dict[str, str]]) -> requests.Response:
     """使用新版XAI API调用
     
     Args:
         messages: 消息历史记录
         
     Returns:
-        完整的响应文本
-    """
-    if not API_KEYS["xai"]:
-        return colored_text(f"错误: 未配置XAI API密钥", Fore.RED)
+        流式响应对象
         
+    Raises:
+        requests.RequestException: 请求失败或返回错误状态码
+    """
     # 使用requests库模拟新版API调用
-    headers = {
-        "Authorization": f"Bearer {API_KEYS['xai']}", 
-        "Content-Type": "application/json"
-    }
-    
     data = {
         "model": MODEL_MAP["xai"],
         "messages": messages,
         "stream": True
     }
     
-    try:
-        # 使用会话对象以便复用连接
-        session = requests.Session()
-        response = session.post(
-            f"{API_ENDPOINTS['xai']}/chat/completions",
-            headers=headers,
-            json=data,
-            proxies=proxies,
-            timeout=60,
-            stream=True
-        )
-        response.raise_for_status()
-        
-        # 返回响应流
-        return response
-    except Exception as e:
-        print(colored_text(f"XAI API调用出错: {str(e)}", Fore.RED))
-        return None
+    # 使用常驻会话对象以便复用连接；出错时抛出异常，由调用方在停止思考动画后报告
+    response = SESSIONS["xai"].post(
+        f"{API_ENDPOINTS['xai']}/chat/completions",
+        json=data,
+        timeout=60,
+        stream=True
+    )
+    response.raise_for_status()
+    
+    # 返回响应流
+    return response
 
-def call_deepseek_api(messages: List[Dict[str, str]]) -> str:
+def call_deepseek_api(messages: List[Dict[str, str]]) -> requests.Response:
     """使用DeepSeek API调用
     
     Args:
         messages: 消息历史记录
         
     Returns:
-        完整的响应文本
-    """
-    if not API_KEYS["deepseek"]:
-        return colored_text(f"错误: 未配置DeepSeek API密钥", Fore.RED)
+        流式响应对象
         
-    headers = {
-        "Authorization": f"Bearer {API_KEYS['deepseek']}", 
-        "Content-Type": "application/json"
-    }
-    
+    Raises:
+        requests.RequestException: 请求失败或返回错误状态码
+    """
     data = {
         "model": MODEL_MAP["deepseek"],
         "messages": messages,
         "stream": True
     }
     
-    try:
-        # 使用会话对象以便复用连接
-        session = requests.Session()
-        response = session.post(
-            f"{API_ENDPOINTS['deepseek']}/chat/completions",
-            headers=headers,
-            json=data,
-            proxies=proxies,
-            timeout=60,
-            stream=True
-        )
-        response.raise_for_status()
-        
-        # 返回响应流
-        return response
-    except Exception as e:
-        print(colored_text(f"DeepSeek API调用出错: {str(e)}", Fore.RED))
-        return None
+    # 使用常驻会话对象以便复用连接；出错时抛出异常，由调用方在停止思考动画后报告
+    response = SESSIONS["deepseek"].post(
+        f"{API_ENDPOINTS['deepseek']}/chat/completions",
+        json=data,
+        timeout=60,
+        stream=True
+    )
+    response.raise_for_status()
+    
+    # 返回响应流
+    return response
+
+# 模型到API调用函数的映射
+_API_CALLS = {
+    "openai": call_openai_api,
+    "xai": call_xai_api,
+    "deepseek": call_deepseek_api,
+}
 
-def stream_response(model: str, messages: List[Dict[str, str]]) -> str:
+def stream_response(model: str, messages: List[Dict[str, str]],
+                    on_connected: Optional[Callable[[], None]] = None) -> Tuple[str, bool]:
     """流式获取API响应
     
     Args:
         model: 模型类型 (openai/deepseek/xai)
         messages: 消息历史记录
+        on_connected: 请求返回(或失败)后调用的回调，用于在等待响应期间保持思考动画
         
     Returns:
-        完整的响应文本
+        完整的响应文本(失败时为错误信息)和请求是否成功的标志
     """
-    if model == "openai" and API_KEYS["openai"]:
-        response_stream = call_openai_api(messages)
-    elif model == "xai" and API_KEYS["xai"]:
-        response_stream = call_xai_api(messages)
-    elif model == "deepseek" and API_KEYS["deepseek"]:
-        response_stream = call_deepseek_api(messages)
-    else:
-        return colored_text(f"错误: 模型{model}不可用或未配置API密钥", Fore.RED)
+    api_error = None
+    try:
+        # _VALID_MODELS在启动时已按API密钥过滤，无需再逐次检查密钥
+        if model not in _VALID_MODELS:
+            return colored_text(f"错误: 模型{model}不可用或未配置API密钥", Fore.RED), False
+        try:
+            response_stream = _API_CALLS[model](messages)
+        except Exception as e:
+            api_error = e
+    finally:
+        if on_connected:
+            on_connected()
     
-    if response_stream is None:
-        return colored_text(f"错误: 无法连接到{model}服务", Fore.RED)
+    if api_error is not None:
+        # 思考动画已停止，再输出错误，避免和动画帧挤在同一行
+        print(colored_text(f"{model} API调用出错: {str(api_error)}", Fore.RED))
+        return colored_text(f"错误: 无法连接到{model}服务", Fore.RED), False
         
-    full_message = ""
     # 确保在新行开始输出模型回复
     print(f"\n{Fore.GREEN}({model}){Style.RESET_ALL}：", end="", flush=True)
     
     try:
-        for line in response_stream.iter_lines():
-            if not line:
-                continue
-                
-            # 解析SSE格式的数据
-            line = line.decode('utf-8')
-            if line.startswith("data: "):
-                if line == "data: [DONE]":
-                    break
-                    
-                try:
-                    chunk_data = json.loads(line[6:])
-                    if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                        delta = chunk_data["choices"][0].get("delta", {})
-                        if "content" in delta:
-                            content = delta["content"]
-                            print(content, end="", flush=True)
-                            full_message += content
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(colored_text(f"\n解析响应出错: {str(e)}", Fore.RED))
+        if HAS_RICH and USE_MARKDOWN:
+            print()  # Markdown从新行开始渲染
+            return _stream_markdown(response_stream), True
         
-        print()  # 确保最后换行
-        return full_message
+        chunks: List[str] = []
+        unflushed: List[str] = []  # 尚未写出的增量
+        last_flush = time.monotonic()
+        for content in _iter_stream_content(response_stream):
+            chunks.append(content)
+            unflushed.append(content)
+            # 攒一批再写出，遇到换行或超过刷新间隔时才刷新终端
+            now = time.monotonic()
+            if "\n" in content or now - last_flush > STREAM_FLUSH_INTERVAL:
+                sys.stdout.write("".join(unflushed))
+                sys.stdout.flush()
+                unflushed.clear()
+                last_flush = now
+        unflushed.append("\n")  # 确保最后换行
+        sys.stdout.write("".join(unflushed))
+        sys.stdout.flush()
+        return "".join(chunks), True
     except Exception as e:
-        return colored_text(f"{model}请求错误: {str(e)}", Fore.RED)
+        return colored_text(f"{model}请求错误: {str(e)}", Fore.RED), False
+
+def _iter_stream_content(response_stream):
+    """解析SSE格式的响应流，逐个返回增量文本
+    
+    Args:
+        response_stream: API返回的流式响应
+        
+    Yields:
+        模型输出的增量文本
+    """
+    for line in response_stream.iter_lines():
+        # 解析SSE格式的数据，直接处理字节，不先解码为字符串
+        if line.startswith(b"data: "):
+            if line == b"data: [DONE]":
+                break
+                
+            try:
+                chunk_data = json_loads(line[6:])
+                if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+                    delta = chunk_data["choices"][0].get("delta", {})
+                    if "content" in delta:
+                        yield delta["content"]
+            except json.JSONDecodeError:
+                continue
+            except Exception as e:
+                print(colored_text(f"\n解析响应出错: {str(e)}", Fore.RED))
+
+class _RenderBoundaryScanner:
+    """增量查找流式文本中可以安全渲染的位置(代码块和列表外的空行之后，或代码块闭合之后)
+    
+    扫描状态在多次调用之间保留，每次只从上次扫描到的完整行之后继续，
+    不必在每个增量到达时从头重新扫描尚未渲染的文本
+    """
+    
+    def __init__(self):
+        self.pos = 0  # 下一次扫描的起点(总在行首)
+        self.in_code_block = False
+        self.in_list = False
+        self.list_blank = 0  # 列表中空行之后的位置，要看下一行才知道列表是否结束
+    
+    def feed(self, text: str) -> int:
+        """继续扫描尚未渲染的文本中新增的完整行
+        
+        调用方需要丢弃返回位置之前的部分，之后传入剩余的文本(可追加新内容)
+        
+        Args:
+            text: 尚未渲染的文本
+            
+        Returns:
+            可渲染部分的结束位置，没有完整段落时返回0
+        """
+        boundary = 0
+        pos = self.pos
+        while True:
+            newline = text.find("\n", pos)
+            if newline == -1:
+                break
+            line = text[pos:newline]
+            stripped = line.lstrip()
+            if self.in_code_block:
+                # 代码块可能有缩进(例如在列表项中)
+                if stripped.startswith("```"):
+                    self.in_code_block = False
+                    if not self.in_list:
+                        boundary = newline + 1
+            elif not stripped:
+                if self.in_list:
+                    self.list_blank = newline + 1
+                else:
+                    boundary = newline + 1
+            else:
+                if self.list_blank and not _LIST_ITEM_RE.match(line) and line[0] not in " \t":
+                    # 空行之后既不是列表项也不是缩进的续行，列表到此结束
+                    boundary = self.list_blank
+                    self.in_list = False
+                self.list_blank = 0
+                if _LIST_ITEM_RE.match(line):
+                    self.in_list = True
+                if stripped.startswith("```"):
+                    self.in_code_block = True
+            pos = newline + 1
+        
+        # 已渲染的部分会被丢弃，位置改为相对于剩余文本
+        self.pos = pos - boundary
+        if self.list_blank:
+            self.list_blank -= boundary
+        return boundary
+
+def _chunk_gap_before(text: str) -> bool:
+    """分段渲染时，这一段之前是否需要补一个空行
+    
+    与整段渲染保持一致: 代码块紧接在正文之后输出；Rich渲染列表、引用和表格时自带前导空行
+    
+    Args:
+        text: 这一段的文本(已去掉开头的空行)
+        
+    Returns:
+        是否需要补空行
+    """
+    return not (text.lstrip().startswith(("```", ">", "|")) or _LIST_ITEM_RE.match(text))
+
+def _chunk_gap_after(text: str) -> bool:
+    """分段渲染时，以空行结束的这一段之后是否需要补一个空行
+    
+    整段渲染中，代码块和分隔线之后不会再空一行
+    
+    Args:
+        text: 这一段的文本(已去掉末尾的空行)
+        
+    Returns:
+        是否需要补空行
+    """
+    lines = text.rsplit("\n", 2)
+    last = lines[-1]
+    if last.lstrip().startswith("```"):
+        return False
+    if _HR_RE.match(last):
+        # 紧跟在正文行之后的---是二级标题的下划线，不是分隔线
+        return len(lines) > 1 and lines[-2].strip() != "" and set(last.strip()) == {"-"}
+    return True
+
+def _live_tail(text: str) -> "Text":
+    """取尚未渲染文本的最后几行，用于在Live区域中显示
+    
+    Live区域超出终端高度时会截掉底部，只保留能显示下的行，使新到达的内容始终可见
+    
+    Args:
+        text: 尚未渲染的文本
+        
+    Returns:
+        要显示的文本
+    """
+    rows = console.height - 1
+    width = max(console.width, 1)
+    start = end = len(text)
+    while start > 0:
+        line_start = text.rfind("\n", 0, end) + 1
+        # 按终端宽度计算换行后占用的行数
+        rows -= max(1, -(-cell_len(text[line_start:end]) // width))
+        if rows < 0 and start < len(text):
+            break
+        start = line_start
+        end = line_start - 1
+    return Text(text[start:])
+
+def _stream_markdown(response_stream) -> str:
+    """边接收边渲染Markdown
+    
+    完整的段落和代码块一旦结束就立即渲染，未完成的部分在Live区域实时显示
+    
+    Args:
+        response_stream: API返回的流式响应
+        
+    Returns:
+        完整的响应文本
+    """
+    chunks: List[str] = []  # 完整回复的所有增量
+    pending: List[str] = []  # 尚未渲染的增量
+    tail = Text()  # Live区域中显示的未渲染部分
+    scanner = _RenderBoundaryScanner()
+    need_blank = False  # 上一段之后需要补一个空行
+    
+    def render_chunk(text: str):
+        nonlocal need_blank
+        # 分段渲染时段间空行会丢失，去掉首尾的空行，由这里按整段渲染的效果补上
+        body = text.lstrip("\n").rstrip()
+        if not body:
+            return
+        if need_blank and _chunk_gap_before(body):
+            console.print()
+        render_markdown(body)
+        ended_blank = text.count("\n", len(text.rstrip())) >= 2
+        need_blank = ended_blank and _chunk_gap_after(body)
+    
+    with Live(tail, console=console, refresh_per_second=10, transient=True) as live:
+        for content in _iter_stream_content(response_stream):
+            chunks.append(content)
+            pending.append(content)
+            if "\n" in content:
+                text = "".join(pending)
+                boundary = scanner.feed(text)
+                if boundary:
+                    # Live运行期间的输出会显示在实时区域上方
+                    render_chunk(text[:boundary])
+                    text = text[boundary:]
+                pending = [text] if text else []
+                tail = _live_tail(text)
+                live.update(tail)
+                continue
+            tail.append(content)
+    
+    # 渲染最后剩余的部分
+    render_chunk("".join(pending))
+    return "".join(chunks)
 
 def fallback_response() -> str:
     """当所有API都失败时使用的本地回复
@@ -931,17 +1272,16 @@ def process_response(response: str) -> Tuple[str, List[Dict[str, str]], List[str
     
     # 提取可能的命令行命令 (以!或$开头的行)
     commands = []
-    command_pattern = r"^(?:\!|\$)\s*(.+)$"
     
     for line in response.split('\n'):
-        match = re.match(command_pattern, line.strip())
+        match = _CMD_LINE_RE.match(line.strip())
         if match:
             cmd = match.group(1).strip()
             if cmd and not is_dangerous_command(cmd):
                 commands.append(cmd)
     
     # 从响应中移除命令提示符，使显示更干净
-    cleaned_response = re.sub(r"^(?:\!|\$)\s*(.+)$", r"\1", response, flags=re.MULTILINE)
+    cleaned_response = _CMD_LINE_RE.sub(r"\1", response)
     
     return cleaned_response, code_blocks, commands
 
@@ -975,6 +1315,9 @@ def handle_code_blocks(code_blocks: List[Dict[str, str]]) -> None:
     """
     if not code_blocks:
         return
+    
+    # 当前目录在处理期间不会改变，只获取一次
+    current_dir = os.getcwd()
         
     for block in code_blocks:
         suggested_filename = suggest_filename(block)
@@ -983,7 +1326,6 @@ def handle_code_blocks(code_blocks: List[Dict[str, str]]) -> None:
         is_command = block.get("is_command", False)
         
         # 提供文件的绝对路径
-        current_dir = os.getcwd()
         full_path = os.path.join(current_dir, suggested_filename)
         
         # 区分命令和脚本的提示信息
@@ -1045,6 +1387,19 @@ def handle_code_blocks(code_blocks: List[Dict[str, str]]) -> None:
         else:
             print(colored_text("已取消写入", Fore.YELLOW))
 
+def _confirm(cmd: str) -> bool:
+    """询问用户是否执行命令
+    
+    Args:
+        cmd: 要显示的命令
+        
+    Returns:
+        用户输入y时返回True
+    """
+    sys.stdout.write(colored_text(f"！是否执行:`{cmd}`? (y/n)", Fore.GREEN) + "\n")
+    sys.stdout.flush()
+    return sys.stdin.readline().strip().lower() == 'y'
+
 def handle_executable_file(file_path: str, language: str) -> None:
     """处理可执行文件(添加执行权限并询问是否执行)
     
@@ -1054,32 +1409,39 @@ def handle_executable_file(file_path: str, language: str) -> None:
     """
     # 对特定类型的文件询问是否执行
     if language in ["sh", "bash", "shell"] or file_path.endswith(".sh"):
-        cmd = f"chmod +x {file_path}"
-        print(colored_text(f"！是否执行:`{cmd}`? (y/n)", Fore.GREEN))
-        if input().strip().lower() == 'y':
-            output, success = execute_command(cmd)
-            if success:
-                print(colored_text("权限设置成功", Fore.GREEN))
-                
-                cmd = f"{file_path}"
-                print(colored_text(f"！是否执行:`{cmd}`? (y/n)", Fore.GREEN))
-                if input().strip().lower() == 'y':
-                    output, success = execute_command(cmd)
-                    # 结果已在execute_command中输出
+        cmd = ["chmod", "+x", file_path]
+        if _confirm(shlex.join(cmd)):
+            # 直接调用chmod系统调用，不必启动shell
+            try:
+                mode = os.stat(file_path).st_mode
+                os.chmod(file_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            except OSError as e:
+                print(colored_text(f"权限设置失败: {e}", Fore.RED))
+                return
+            print(colored_text("权限设置成功", Fore.GREEN))
+            
+            # 没有shebang的脚本无法直接exec，与shell的做法一致，交给sh解释
+            try:
+                with open(file_path, "rb") as f:
+                    has_shebang = f.read(2) == b"#!"
+            except OSError:
+                has_shebang = False
+            cmd = [file_path] if has_shebang else ["sh", file_path]
+            if _confirm(shlex.join(cmd)):
+                output, success = execute_command(cmd)
+                # 结果已在execute_command中输出
     
     # 对Python文件询问是否执行
     elif language in ["python", "py"] or file_path.endswith(".py"):
-        cmd = f"python3 {file_path}"
-        print(colored_text(f"！是否执行:`{cmd}`? (y/n)", Fore.GREEN))
-        if input().strip().lower() == 'y':
+        cmd = ["python3", file_path]
+        if _confirm(shlex.join(cmd)):
             output, success = execute_command(cmd)
             # 结果已在execute_command中输出
     
     # 对JavaScript文件询问是否使用Node执行
     elif language in ["javascript", "js"] or file_path.endswith(".js"):
-        cmd = f"node {file_path}"
-        print(colored_text(f"！是否执行:`{cmd}`? (y/n)", Fore.GREEN))
-        if input().strip().lower() == 'y':
+        cmd = ["node", file_path]
+        if _confirm(shlex.join(cmd)):
             output, success = execute_command(cmd)
             # 结果已在execute_command中输出
 
@@ -1100,42 +1462,32 @@ def chat_once(prompt: str) -> str:
     print(f"{Fore.CYAN}User：{Style.RESET_ALL}{prompt}")
     
     # 启动思考动画
-    stop_thinking = threading.Event()
-    thinking_thread = threading.Thread(target=spinner_animation, args=(stop_thinking,))
-    thinking_thread.daemon = True  # 设置为守护线程，确保主程序退出时线程也会退出
-    thinking_thread.start()
+    spinner.start()
     
     try:
-        # 尝试不同的模型，优先使用当前选择的模型
-        models_to_try = [current_model, "deepseek", "xai", "openai"]
-        models_to_try = list(dict.fromkeys(models_to_try))  # 删除重复
+        # 尝试不同的模型，优先使用当前选择的模型，只尝试已配置密钥的模型
+        models_to_try = (
+            ((current_model,) if current_model in _VALID_MODELS else ())
+            + tuple(m for m in _VALID_MODELS if m != current_model)
+        )
         
         for model in models_to_try:
             try:
-                if not API_KEYS[model]:
-                    continue
-                    
-                # 停止思考动画
-                stop_thinking.set()
-                thinking_thread.join(timeout=1.0)  # 等待思考动画线程结束，设置超时
+                # 尝试使用流式响应，思考动画持续到请求返回为止
+                message, ok = stream_response(model, history, on_connected=spinner.stop)
                 
-                # 尝试使用流式响应
-                message = stream_response(model, history)
-                
-                # 检查是否有错误消息
-                if message.startswith("错误:") or "请求错误" in message:
+                # 检查请求是否失败
+                if not ok:
                     print(colored_text(f"模型 {model} 失败，尝试下一个...", Fore.YELLOW))
                     
                     # 重新启动思考动画
-                    stop_thinking = threading.Event()
-                    thinking_thread = threading.Thread(target=spinner_animation, args=(stop_thinking,))
-                    thinking_thread.daemon = True
-                    thinking_thread.start()
+                    spinner.start()
                     continue
                     
                 # 成功获取响应
                 history.append({"role": "assistant", "content": message})
                 save_to_history("assistant", message)
+                flush_history()  # 本轮的用户和助手记录一次写入
                 current_model = model  # 更新当前使用的模型
                 
                 # 处理响应中的命令和代码块
@@ -1154,49 +1506,62 @@ def chat_once(prompt: str) -> str:
                 print(colored_text(f"模型 {model} 出错: {str(e)}", Fore.RED))
                 
                 # 如果出错，重新启动思考动画
-                if not stop_thinking.is_set():
-                    stop_thinking.set()
-                    thinking_thread.join(timeout=1.0)
-                
-                stop_thinking = threading.Event()
-                thinking_thread = threading.Thread(target=spinner_animation, args=(stop_thinking,))
-                thinking_thread.daemon = True
-                thinking_thread.start()
+                spinner.start()
         
         # 所有模型都失败了
+        spinner.stop()
         fallback_msg = fallback_response()
         history.append({"role": "assistant", "content": fallback_msg})
         save_to_history("assistant", fallback_msg)
-        print_with_typewriter(fallback_msg)
+        flush_history()
+        print_response(fallback_msg)
         return fallback_msg
     finally:
         # 确保思考动画停止
-        if not stop_thinking.is_set():
-            stop_thinking.set()
-            thinking_thread.join(timeout=1.0)
+        spinner.stop()
+
+@functools.lru_cache(maxsize=None)
+def _prompt_key_bindings():
+    """创建交互式输入的按键绑定，只构建一次
+    
+    Returns:
+        prompt_toolkit的KeyBindings对象
+    """
+    from prompt_toolkit.key_binding import KeyBindings
+    
+    bindings = KeyBindings()
+    @bindings.add('enter')
+    def _(event):
+        event.app.exit(result=event.app.current_buffer.text)
+    @bindings.add('s-enter')
+    def _(event):
+        event.app.current_buffer.insert_text('\n')
+    return bindings
 
 def main():
     """主函数，处理命令行参数并启动程序"""
     global current_model, history
     
-    # 确保配置目录存在
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    
     # 解析命令行参数
     if len(sys.argv) < 2:
-        print(colored_text("用法: ganaterm <模型> [问题]", Fore.YELLOW))
-        print(colored_text("模型: g (GPT), d (DeepSeek), x (XAI)", Fore.YELLOW))
-        print(colored_text("例如: ganaterm g '如何在Linux中查找文件?'", Fore.YELLOW))
+        print(colored_text(
+            "用法: ganaterm <模型> [问题]\n"
+            "模型: g (GPT), d (DeepSeek), x (XAI)\n"
+            "例如: ganaterm g '如何在Linux中查找文件?'",
+            Fore.YELLOW
+        ))
         return
 
     # 测试兼容性并显示配置信息
     if len(sys.argv) > 1 and sys.argv[1] in ["--test", "-t"]:
         print(colored_text("Ganaterm 终端兼容性测试:", Fore.CYAN))
-        print(f"Shell: {SHELL} (ZSH: {IS_ZSH})")
-        print(f"终端: {TERM} (支持良好: {IS_TERM_SUPPORTED})")
-        print(f"颜色支持: {COLORTERM} (真彩色: {HAS_TRUECOLOR})")
-        print(f"Rich库可用: {HAS_RICH}")
-        print(f"Markdown渲染: {USE_MARKDOWN}")
+        print(
+            f"Shell: {SHELL} (ZSH: {IS_ZSH})\n"
+            f"终端: {TERM} (支持良好: {IS_TERM_SUPPORTED})\n"
+            f"颜色支持: {COLORTERM} (真彩色: {HAS_TRUECOLOR})\n"
+            f"Rich库可用: {HAS_RICH}\n"
+            f"Markdown渲染: {USE_MARKDOWN}"
+        )
         
         if HAS_RICH:
             print("\n终端展示示例:")
@@ -1206,22 +1571,16 @@ def main():
             console.print("[green]成功文本[/green]")
             console.print("内联代码示例: " + f"[{INLINE_CODE_STYLE}]`print('Hello')`[/{INLINE_CODE_STYLE}]")
             
+            from rich.syntax import Syntax
+            
             # 显示不同语言的代码高亮
             print("\n代码高亮测试:")
             python_code = "def hello():\n    print('Hello, world!')"
-            term_width = shutil.get_terminal_size().columns
             
             # 创建边框
-            lang_label = " python "
-            fill_length = term_width - len(lang_label) - 4
-            if fill_length < 0: 
-                fill_length = 0
-                
-            top_border = f"{CODE_BOX_TOP_LEFT}{CODE_BOX_HORIZONTAL*2}{lang_label}{CODE_BOX_HORIZONTAL * fill_length}{CODE_BOX_TOP_RIGHT}"
-            bottom_border = f"{CODE_BOX_BOTTOM_LEFT}{CODE_BOX_HORIZONTAL * (term_width - 2)}{CODE_BOX_BOTTOM_RIGHT}"
+            top_border, bottom_border = _borders(" python ", _TERM_WIDTH)
             
             # 显示Python代码测试
-            console.print(top_border, style=CODE_BOX_STYLE)
             syntax = Syntax(
                 python_code, 
                 "python", 
@@ -1230,8 +1589,7 @@ def main():
                 word_wrap=True,
                 background_color="default"
             )
-            console.print(syntax)
-            console.print(bottom_border, style=CODE_BOX_STYLE)
+            console.print(Group(Text(top_border, style=CODE_BOX_STYLE), syntax, Text(bottom_border, style=CODE_BOX_STYLE)))
             
             print("\n配置提示:")
             if IS_ZSH:
@@ -1241,45 +1599,37 @@ def main():
             
             print(colored_text("\n如果代码块显示不正确，可以在~/.config/ganaterm/.env中设置:", Fore.CYAN))
             print("USE_MARKDOWN=false # 禁用富文本渲染")
-            print("USE_TYPEWRITER=false # 禁用打字机效果")
         
         return
 
     # 设置模型
-    model_flag = sys.argv[1]
-    if model_flag == "g":
-        current_model = "openai"
-    elif model_flag == "d":
-        current_model = "deepseek"
-    elif model_flag == "x":
-        current_model = "xai"
-    else:
+    model = _MODEL_FLAGS.get(sys.argv[1])
+    if model is None:
         print(colored_text("错误: 模型只能是 g (GPT), d (DeepSeek), x (XAI)", Fore.RED))
         return
+    current_model = model
 
-    # 加载历史记录
+    # 加载历史记录(可能会轮转历史文件)，之后再打开历史文件用于追加
     history = load_history()
+    open_history_file()
     
     # 获取用户输入
     if len(sys.argv) > 2:
         # 从命令行参数获取
         prompt = " ".join(sys.argv[2:])
     else:
-        # 交互式输入
-        bindings = KeyBindings()
-        @bindings.add('enter')
-        def _(event):
-            event.app.exit(result=event.app.current_buffer.text)
-        @bindings.add('s-enter')
-        def _(event):
-            event.app.current_buffer.insert_text('\n')
-
-        session = PromptSession(
-            "你说（Shift+Enter 换行，Enter 提交）：", 
-            multiline=True, 
-            key_bindings=bindings
-        )
-        prompt = session.prompt()
+        # 交互式输入，只在需要时才导入prompt_toolkit
+        try:
+            from prompt_toolkit import PromptSession
+        except ImportError:
+            prompt = input("你说：")
+        else:
+            session = PromptSession(
+                "你说（Shift+Enter 换行，Enter 提交）：", 
+                multiline=True, 
+                key_bindings=_prompt_key_bindings()
+            )
+            prompt = session.prompt()
 
     # 检查输入是否为空
     if not prompt.strip():